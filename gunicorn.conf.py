@@ -0,0 +1,24 @@
+# Production server settings: gunicorn -c gunicorn.conf.py main:app
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Sessions and their pending audio live in process memory, so every request
+# for a session must reach the same process: one worker, scaled with threads.
+# WEB_CONCURRENCY is deliberately not read, since hosts set it automatically.
+workers = 1
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '8'))
+
+# No preload_app: main.py starts background threads at import (the TTS
+# warm-up among them), and threads running in the master don't survive a fork.
+
+# Hold idle connections open past the browser's gap between turns so each
+# fetch reuses the socket; HTTP/2 and TLS are terminated by the proxy in front
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '75'))
+
+
+def post_worker_init(worker):
+    # The app is loaded in the worker by now; start connecting its gRPC channel
+    import main
+    main.warm_speech_channel()
@@ -1,19 +1,101 @@
 import os
+import atexit
+import logging
+import logging.handlers
+import queue
 import json
-from flask import Flask, request, jsonify
+import orjson
+import asyncio
+import collections
+import time
+from flask import Flask, Response, request, jsonify, url_for
+from flask_compress import Compress
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from flask_sock import Sock
+from simple_websocket import ConnectionClosed
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from google.cloud import speech_v1p1beta1 as speech
-import base64
+from google.cloud.speech_v1p1beta1.services.speech.transports import SpeechGrpcTransport
+import pybase64
+import brotli
+import gzip
 from dotenv import load_dotenv
 from gtts import gTTS
-import tempfile
+import hashlib
+import itertools
+import string
+import re
+from types import MappingProxyType
+import io
+from concurrent.futures import Future, ThreadPoolExecutor
+from diskcache import Cache
+import threading
+from cachetools import LRUCache, TTLCache
+import numpy as np
+import faiss
+from sentence_transformers import SentenceTransformer
 
 # Load environment variables from .env file
 load_dotenv()
 
+class ProcessQueueHandler(logging.handlers.QueueHandler):
+    """Hand records, unformatted, to a listener thread that formats and writes them.
+
+    The listener is started on first use in each process, since a thread
+    started before a fork does not exist in the child.
+    """
+    
+    def __init__(self, target):
+        super().__init__(queue.SimpleQueue())
+        self._target = target
+        self._listener_pid = None
+        self._start_lock = threading.Lock()
+    
+    def prepare(self, record):
+        # Formatting (tracebacks included) is left to the listener thread
+        return record
+    
+    def enqueue(self, record):
+        if self._listener_pid != os.getpid():
+            self._start_listener()
+        self.queue.put_nowait(record)
+    
+    def _start_listener(self):
+        with self._start_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self.queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(self.queue, self._target)
+            listener.start()
+            atexit.register(listener.stop)
+            self._listener_pid = os.getpid()
+
+
+log_output = logging.StreamHandler()
+log_output.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+logging.basicConfig(level=logging.INFO, handlers=[ProcessQueueHandler(log_output)])
+logger = logging.getLogger(__name__)
+logger.info("pybase64 %s", pybase64.get_version())
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, which is faster and keeps non-ASCII text unescaped"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Prefer Brotli for JSON replies; tiny bodies aren't worth the compression overhead
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 512
+Compress(app)
 CORS(app, resources={r"/*": {"origins": "*"}})
+sock = Sock(app)
 
 # Configure Gemini API
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
@@ -21,43 +103,100 @@ if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY not found in environment variables")
 genai.configure(api_key=GEMINI_API_KEY)
 
-# List available models and select one
-print("\n=== Available Gemini Models ===")
-available_models = []
-try:
-    for m in genai.list_models():
-        if 'generateContent' in m.supported_generation_methods:
-            model_name = m.name.replace('models/', '')
-            available_models.append(model_name)
-            print(f"  ✓ {model_name}")
-except Exception as e:
-    print(f"Error listing models: {e}")
-
-# Try to initialize model with fallback options
-model = None
-model_options = [
-    'gemini-1.5-flash',
-    'gemini-1.5-pro',
-    'gemini-pro',
-    'gemini-1.0-pro'
-]
-
-if available_models:
-    model_options = available_models[:3] + model_options
+# The working model is chosen lazily and remembered across restarts/workers.
+# Model names get retired, so the remembered name expires and is dropped as
+# soon as Gemini reports it unknown.
+MODEL_CACHE_FILE = os.path.join(os.path.dirname(__file__), '.gemini_model_cache')
+MODEL_CACHE_TTL = 7 * 24 * 3600
+# Only NotFound means the model itself is gone; other 400s (bad key, oversized
+# request, rejected schema) propagate without touching the model cache
+MODEL_GONE_ERRORS = (google_exceptions.NotFound,)
+_model = None
+_model_lock = threading.Lock()
 
-for model_name in model_options:
+def discover_model():
+    """List available models and probe candidates until one responds"""
+    logger.info("=== Available Gemini Models ===")
+    available_models = []
     try:
-        model = genai.GenerativeModel(model_name)
-        test = model.generate_content("Hi")
-        print(f"\n✅ Successfully using model: {model_name}\n")
-        break
+        for m in genai.list_models():
+            if 'generateContent' in m.supported_generation_methods:
+                model_name = m.name.replace('models/', '')
+                available_models.append(model_name)
+                logger.info("  ✓ %s", model_name)
     except Exception as e:
-        print(f"  ✗ Failed to use {model_name}: {str(e)[:100]}")
-        continue
-
-if model is None:
+        logger.warning("Error listing models: %s", e)
+    
+    # Try to initialize model with fallback options
+    model_options = [
+        'gemini-1.5-flash',
+        'gemini-1.5-pro',
+        'gemini-pro',
+        'gemini-1.0-pro'
+    ]
+    
+    if available_models:
+        model_options = available_models[:3] + model_options
+    
+    for model_name in model_options:
+        try:
+            candidate = genai.GenerativeModel(model_name)
+            candidate.generate_content("Hi")
+            logger.info("✅ Successfully using model: %s", model_name)
+            return model_name, candidate
+        except Exception as e:
+            logger.warning("  ✗ Failed to use %s: %s", model_name, str(e)[:100])
+            continue
+    
     raise ValueError("Could not initialize any Gemini model. Please check your API key.")
 
+def get_model():
+    """Return the shared Gemini model, reusing the cached model name when available"""
+    global _model
+    if _model is not None:
+        return _model
+    
+    with _model_lock:
+        if _model is not None:
+            return _model
+        
+        try:
+            with open(MODEL_CACHE_FILE, 'r', encoding='utf-8') as cache_file:
+                cached = json.load(cache_file)
+            if time.time() - cached['timestamp'] < MODEL_CACHE_TTL:
+                _model = genai.GenerativeModel(cached['model_name'])
+                logger.info("✅ Using cached model: %s", cached['model_name'])
+                return _model
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        
+        model_name, _model = discover_model()
+        
+        try:
+            with open(MODEL_CACHE_FILE, 'w', encoding='utf-8') as cache_file:
+                json.dump({'model_name': model_name, 'timestamp': time.time()}, cache_file)
+        except OSError as e:
+            logger.warning("Could not write model cache: %s", e)
+        
+        return _model
+
+def forget_model(model):
+    """Drop a model Gemini no longer serves so the next get_model() rediscovers one"""
+    global _model, _summary_model
+    with _model_lock:
+        if model is not None and model is _summary_model:
+            logger.warning("Summary model %s is unavailable; using the chat model", model.model_name)
+            _summary_model = None
+            return
+        if model is None or model is not _model:
+            return
+        logger.warning("Model %s is no longer available; rediscovering", model.model_name)
+        _model = None
+        try:
+            os.remove(MODEL_CACHE_FILE)
+        except OSError:
+            pass
+
 # Set Google Cloud credentials
 GOOGLE_APPLICATION_CREDENTIALS = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 if not GOOGLE_APPLICATION_CREDENTIALS:
@@ -71,109 +210,259 @@ if not os.path.exists(GOOGLE_APPLICATION_CREDENTIALS):
 
 os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = GOOGLE_APPLICATION_CREDENTIALS
 
-# Initialize Google Speech client
-speech_client = speech.SpeechClient()
+# Google Speech client with a long-lived, keepalive gRPC channel. It is created
+# lazily because gRPC channels cannot be shared across a pre-fork server's fork.
+SPEECH_ENDPOINT = 'speech.googleapis.com:443'
+SPEECH_CHANNEL_OPTIONS = [
+    ('grpc.max_send_message_length', -1),
+    ('grpc.max_receive_message_length', -1),
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.keepalive_timeout_ms', 10000)
+]
+_speech_client = None
+_speech_client_lock = threading.Lock()
+
+def get_speech_client():
+    """Return this process's shared Speech client"""
+    global _speech_client
+    if _speech_client is not None:
+        return _speech_client
+    
+    with _speech_client_lock:
+        if _speech_client is None:
+            channel = SpeechGrpcTransport.create_channel(SPEECH_ENDPOINT, options=SPEECH_CHANNEL_OPTIONS)
+            _speech_client = speech.SpeechClient(
+                transport=SpeechGrpcTransport(host=SPEECH_ENDPOINT, channel=channel)
+            )
+        return _speech_client
+
+def warm_speech_channel():
+    """Start connecting the Speech channel so the first request skips the TCP/TLS handshake"""
+    channel = get_speech_client().transport.grpc_channel
+    channel.subscribe(lambda connectivity: None, try_to_connect=True)
+
+# Language lookup tables, built once and read-only
+TTS_LANG_MAP = MappingProxyType({
+    'english': 'en',
+    'hindi': 'hi',
+    'kannada': 'kn',
+    'tamil': 'ta',
+    'telugu': 'te',
+    'malayalam': 'ml',
+    'bengali': 'bn'
+})
+
+STT_LANG_MAP = MappingProxyType({
+    'english': 'en-US',
+    'hindi': 'hi-IN',
+    'kannada': 'kn-IN',
+    'tamil': 'ta-IN',
+    'telugu': 'te-IN',
+    'malayalam': 'ml-IN',
+    'bengali': 'bn-IN'
+})
+
+# Shared pool for gTTS requests, which are I/O bound
+TTS_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix='tts')
+
+# Recently used audio stays in memory; everything persists on disk across restarts
+tts_memory_cache = LRUCache(maxsize=1024)
+tts_memory_lock = threading.Lock()
+tts_cache = Cache(os.path.join(os.path.dirname(__file__), 'tts_cache'))
+
+def _speech_cache_key(text, lang_code):
+    return hashlib.sha256((lang_code + "|" + text).encode('utf-8')).hexdigest()
+
+def _get_cached_speech(cache_key):
+    with tts_memory_lock:
+        audio_data = tts_memory_cache.get(cache_key)
+    if audio_data is not None:
+        return audio_data
+    
+    # Entries written before audio was served as raw bytes are re-synthesized
+    audio_data = tts_cache.get(cache_key)
+    if not isinstance(audio_data, bytes):
+        return None
+    
+    with tts_memory_lock:
+        tts_memory_cache[cache_key] = audio_data
+    return audio_data
+
+def _store_speech(cache_key, audio_data):
+    with tts_memory_lock:
+        tts_memory_cache[cache_key] = audio_data
+    tts_cache.set(cache_key, audio_data)
+
+def synthesize_speech(text, lang_code):
+    """Return MP3 bytes for text, using the caches before calling gTTS"""
+    cache_key = _speech_cache_key(text, lang_code)
+    
+    audio_data = _get_cached_speech(cache_key)
+    if audio_data is not None:
+        return audio_data
+    
+    tts = gTTS(text=text, lang=lang_code, slow=False)
+    
+    audio_buffer = io.BytesIO()
+    tts.write_to_fp(audio_buffer)
+    audio_data = audio_buffer.getvalue()
+    
+    _store_speech(cache_key, audio_data)
+    
+    return audio_data
 
 def text_to_speech(text, language):
-    """Convert text to speech and return base64 encoded audio"""
+    """Convert text to speech and return MP3 bytes"""
     try:
-        tts_lang_map = {
-            'english': 'en',
-            'hindi': 'hi',
-            'kannada': 'kn',
-            'tamil': 'ta',
-            'telugu': 'te',
-            'malayalam': 'ml',
-            'bengali': 'bn'
-        }
-        
-        lang_code = tts_lang_map.get(language, 'en')
+        lang_code = TTS_LANG_MAP.get(language, 'en')
         
-        tts = gTTS(text=text, lang=lang_code, slow=False)
+        return synthesize_speech(text, lang_code)
         
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp3') as temp_audio:
-            tts.save(temp_audio.name)
-            temp_audio_path = temp_audio.name
-        
-        with open(temp_audio_path, 'rb') as audio_file:
-            audio_data = audio_file.read()
-            audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-        
-        os.unlink(temp_audio_path)
-        
-        return audio_base64
-        
-    except Exception as e:
-        print(f"TTS Error: {e}")
+    except Exception:
+        logger.exception("TTS Error")
         return None
 
-# Store conversation history
-conversations = {}
+# Replies are spoken sentence by sentence so the first one can play while the rest synthesize
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?।])\s+')
 
-class ConversationManager:
-    def __init__(self, topic, lesson_content, language='english'):
-        self.topic = topic
-        self.lesson_content = lesson_content
-        self.language = language.lower()
-        self.history = []
-        self.turn_count = 0
-        self.max_turns = 10
-        
-    def get_system_prompt(self):
-        language_configs = {
-            'english': {
-                'name': 'English',
-                'instruction': 'Respond in English',
-                'aspects': 'pronunciation, grammar, and vocabulary'
-            },
-            'hindi': {
-                'name': 'Hindi (हिंदी)',
-                'instruction': 'Respond in Hindi (Devanagari script). Use simple, conversational Hindi that a learner would understand.',
-                'aspects': 'pronunciation (उच्चारण), grammar (व्याकरण), and vocabulary (शब्दावली)'
-            },
-            'kannada': {
-                'name': 'Kannada (ಕನ್ನಡ)',
-                'instruction': 'Respond in Kannada (Kannada script). Use simple, conversational Kannada that a learner would understand.',
-                'aspects': 'pronunciation (ಉಚ್ಚಾರಣೆ), grammar (ವ್ಯಾಕರಣ), and vocabulary (ಶಬ್ದಕೋಶ)'
-            },
-            'tamil': {
-                'name': 'Tamil (தமிழ்)',
-                'instruction': 'Respond in Tamil (Tamil script). Use simple, conversational Tamil that a learner would understand.',
-                'aspects': 'pronunciation (உச்சரிப்பு), grammar (இலக்கணம்), and vocabulary (சொல்வளம்)'
-            },
-            'telugu': {
-                'name': 'Telugu (తెలుగు)',
-                'instruction': 'Respond in Telugu (Telugu script). Use simple, conversational Telugu that a learner would understand.',
-                'aspects': 'pronunciation (ఉచ్చారణ), grammar (వ్యాకరణం), and vocabulary (పదకోశం)'
-            },
-            'malayalam': {
-                'name': 'Malayalam (മലയാളം)',
-                'instruction': 'Respond in Malayalam (Malayalam script). Use simple, conversational Malayalam that a learner would understand.',
-                'aspects': 'pronunciation (ഉച്ചാരണം), grammar (വ്യാകരണം), and vocabulary (പദസമ്പത്ത്)'
-            },
-            'bengali': {
-                'name': 'Bengali (বাংলা)',
-                'instruction': 'Respond in Bengali (Bengali script). Use simple, conversational Bengali that a learner would understand.',
-                'aspects': 'pronunciation (উচ্চারণ), grammar (ব্যাকরণ), and vocabulary (শব্দভাণ্ডার)'
-            }
-        }
-        
-        config = language_configs.get(self.language, language_configs['english'])
-        
-        return f"""You are a {config['name']} language learning companion helping a student practice what they've learned.
+def split_sentences(text):
+    return [sentence for sentence in SENTENCE_SPLIT_RE.split(text.strip()) if sentence]
+
+def start_speech(text, language):
+    """Submit every sentence of text to the TTS pool at once, returning futures in order"""
+    return [TTS_POOL.submit(text_to_speech, sentence, language) for sentence in split_sentences(text)]
+
+def stream_speech(futures):
+    """Yield each sentence's MP3 as soon as it and every earlier sentence are ready"""
+    for future in futures:
+        audio_data = future.result()
+        if audio_data is not None:
+            yield audio_data
+
+class SemanticCache:
+    """Reuse Gemini replies for near-duplicate learner messages
+
+    Replies are indexed per exact scope (language, topic) and only the
+    learner's message is embedded, so a shared prefix can't make unrelated
+    messages look alike. At most max_entries replies are kept across all
+    scopes; the oldest is evicted first so memory and search time stay
+    bounded. The cache is only an optimization: failures are logged and
+    treated as misses.
+    """
+    
+    def __init__(self, model_name='paraphrase-multilingual-MiniLM-L12-v2', threshold=0.92, max_entries=5000):
+        self.encoder = SentenceTransformer(model_name)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.dimension = self.encoder.get_sentence_embedding_dimension()
+        self.indexes = {}
+        # id -> (scope, response, metadata), in insertion order for FIFO eviction
+        self.entries = collections.OrderedDict()
+        self._next_id = 0
+        self.lock = threading.Lock()
+    
+    def _embed(self, text):
+        vector = self.encoder.encode([text], normalize_embeddings=True)
+        return np.asarray(vector, dtype='float32')
+    
+    def lookup(self, scope, text):
+        """Return (vector, cached_response); cached_response is None on a miss"""
+        try:
+            vector = self._embed(text)
+            with self.lock:
+                index = self.indexes.get(scope)
+                if index is None or index.ntotal == 0:
+                    return vector, None
+                scores, ids = index.search(vector, 1)
+                if scores[0][0] >= self.threshold and ids[0][0] in self.entries:
+                    _, response_text, _ = self.entries[ids[0][0]]
+                    return vector, response_text
+            return vector, None
+        except Exception:
+            logger.exception("Semantic cache lookup failed")
+            return None, None
+    
+    def add(self, scope, vector, response_text, metadata):
+        if vector is None:
+            return
+        try:
+            with self.lock:
+                index = self.indexes.get(scope)
+                if index is None:
+                    index = self.indexes[scope] = faiss.IndexIDMap(faiss.IndexFlatIP(self.dimension))
+                entry_id = self._next_id
+                self._next_id += 1
+                index.add_with_ids(vector, np.array([entry_id], dtype='int64'))
+                self.entries[entry_id] = (scope, response_text, metadata)
+                
+                if len(self.entries) > self.max_entries:
+                    oldest_id, (oldest_scope, _, _) = self.entries.popitem(last=False)
+                    oldest_index = self.indexes[oldest_scope]
+                    oldest_index.remove_ids(np.array([oldest_id], dtype='int64'))
+                    if oldest_index.ntotal == 0:
+                        del self.indexes[oldest_scope]
+        except Exception:
+            logger.exception("Semantic cache add failed")
 
-Topic: {self.topic}
-Lesson Content: {self.lesson_content}
-Language: {config['name']}
 
-IMPORTANT: {config['instruction']}
+semantic_cache = SemanticCache()
+
+
+LANGUAGE_CONFIGS = MappingProxyType({
+    'english': {
+        'name': 'English',
+        'instruction': 'Respond in English',
+        'aspects': 'pronunciation, grammar, and vocabulary'
+    },
+    'hindi': {
+        'name': 'Hindi (हिंदी)',
+        'instruction': 'Respond in Hindi (Devanagari script). Use simple, conversational Hindi that a learner would understand.',
+        'aspects': 'pronunciation (उच्चारण), grammar (व्याकरण), and vocabulary (शब्दावली)'
+    },
+    'kannada': {
+        'name': 'Kannada (ಕನ್ನಡ)',
+        'instruction': 'Respond in Kannada (Kannada script). Use simple, conversational Kannada that a learner would understand.',
+        'aspects': 'pronunciation (ಉಚ್ಚಾರಣೆ), grammar (ವ್ಯಾಕರಣ), and vocabulary (ಶಬ್ದಕೋಶ)'
+    },
+    'tamil': {
+        'name': 'Tamil (தமிழ்)',
+        'instruction': 'Respond in Tamil (Tamil script). Use simple, conversational Tamil that a learner would understand.',
+        'aspects': 'pronunciation (உச்சரிப்பு), grammar (இலக்கணம்), and vocabulary (சொல்வளம்)'
+    },
+    'telugu': {
+        'name': 'Telugu (తెలుగు)',
+        'instruction': 'Respond in Telugu (Telugu script). Use simple, conversational Telugu that a learner would understand.',
+        'aspects': 'pronunciation (ఉచ్చారణ), grammar (వ్యాకరణం), and vocabulary (పదకోశం)'
+    },
+    'malayalam': {
+        'name': 'Malayalam (മലയാളം)',
+        'instruction': 'Respond in Malayalam (Malayalam script). Use simple, conversational Malayalam that a learner would understand.',
+        'aspects': 'pronunciation (ഉച്ചാരണം), grammar (വ്യാകരണം), and vocabulary (പദസമ്പത്ത്)'
+    },
+    'bengali': {
+        'name': 'Bengali (বাংলা)',
+        'instruction': 'Respond in Bengali (Bengali script). Use simple, conversational Bengali that a learner would understand.',
+        'aspects': 'pronunciation (উচ্চারণ), grammar (ব্যাকরণ), and vocabulary (শব্দভাণ্ডার)'
+    }
+})
+
+
+def _build_template(cfg):
+    """Build the system prompt for one language, leaving per-session fields as format fields"""
+    return f"""You are a {cfg['name']} language learning companion helping a student practice what they've learned.
+
+Topic: {{topic}}
+Lesson Content: {{lesson_content}}
+Language: {cfg['name']}
+
+IMPORTANT: {cfg['instruction']}
 
 Your role:
-1. Have a natural conversation with the student about the topic IN {config['name'].upper()}
+1. Have a natural conversation with the student about the topic IN {cfg['name'].upper()}
 2. Ask questions to assess their understanding
 3. Correct mistakes gently and provide better alternatives
-4. Track {config['aspects']} usage
-5. After {self.max_turns} exchanges, provide a final score and detailed feedback
+4. Track {cfg['aspects']} usage
+5. After {{max_turns}} exchanges, provide a final score and detailed feedback
 
 Conversation guidelines:
 - Keep responses conversational and encouraging
@@ -182,172 +471,569 @@ Conversation guidelines:
 - Be supportive and constructive
 - Use simple, clear language appropriate for a learner
 
-Current turn: {self.turn_count}/{self.max_turns}
+Current turn: {{turn_count}}/{{max_turns}}
 
-If this is the final turn, provide a JSON response with:
-{{
+When a message is marked [FINAL TURN], respond ONLY with this JSON and no other text:
+{{{{
     "final_assessment": true,
     "score": <number out of 100>,
     "stars": <number 1-5>,
-    "message": "<encouraging message IN {config['name'].upper()}>",
-    "what_you_did_well": "<specific praise IN {config['name'].upper()}>",
-    "improvement_tip": {{
+    "message": "<encouraging message IN {cfg['name'].upper()}>",
+    "what_you_did_well": "<specific praise IN {cfg['name'].upper()}>",
+    "improvement_tip": {{{{
         "what_they_said": "<exact problematic phrase>",
-        "better_way": "<corrected phrase IN {config['name'].upper()}>",
-        "explanation": "<why this is better IN {config['name'].upper()}>"
-    }},
-    "detailed_feedback": "<comprehensive feedback IN {config['name'].upper()}>"
-}}
+        "better_way": "<corrected phrase IN {cfg['name'].upper()}>",
+        "explanation": "<why this is better IN {cfg['name'].upper()}>"
+    }}}},
+    "detailed_feedback": "<comprehensive feedback IN {cfg['name'].upper()}>"
+}}}}
+
+Otherwise, respond naturally IN {cfg['name'].upper()} to continue the conversation."""
+
+
+PROMPT_TEMPLATES = MappingProxyType({lang: _build_template(cfg) for lang, cfg in LANGUAGE_CONFIGS.items()})
+
 
-Otherwise, respond naturally IN {config['name'].upper()} to continue the conversation."""
+def _escape_braces(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def _fill_template(template, **fields):
+    """Substitute the given fields, leaving the rest of the template valid for str.format"""
+    parts = []
+    for literal, field_name, _, _ in string.Formatter().parse(template):
+        parts.append(_escape_braces(literal))
+        if field_name is None:
+            continue
+        if field_name in fields:
+            parts.append(_escape_braces(str(fields[field_name])))
+        else:
+            parts.append('{' + field_name + '}')
+    return ''.join(parts)
+
+
+ASSESSMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "integer"},
+        "stars": {"type": "integer"},
+        "message": {"type": "string"},
+        "what_you_did_well": {"type": "string"},
+        "improvement_tip": {
+            "type": "object",
+            "properties": {
+                "what_they_said": {"type": "string"},
+                "better_way": {"type": "string"},
+                "explanation": {"type": "string"}
+            },
+            "required": ["what_they_said", "better_way", "explanation"]
+        },
+        "detailed_feedback": {"type": "string"}
+    },
+    "required": ["score", "stars", "message", "what_you_did_well", "improvement_tip"]
+}
+
+# Used when Gemini's assessment is incomplete or the call fails
+FALLBACK_ASSESSMENT = {
+    "score": 85,
+    "stars": 4,
+    "message": "Great job! You completed the practice session.",
+    "what_you_did_well": "You engaged well in the conversation and showed good understanding of the topic.",
+    "improvement_tip": {
+        "what_they_said": "Your responses",
+        "better_way": "More natural phrasing with complete sentences",
+        "explanation": "Practice using full, polite sentences in conversation"
+    }
+}
+
+ERROR_ASSESSMENT = {
+    "score": 80,
+    "stars": 4,
+    "message": "Well done! You completed the practice session.",
+    "what_you_did_well": "You participated actively and showed effort in practicing.",
+    "improvement_tip": {
+        "what_they_said": "Your conversation",
+        "better_way": "More detailed responses",
+        "explanation": "Try to elaborate more on your answers"
+    }
+}
+
+# English phrases the bot speaks verbatim; they are always read with the English
+# voice and synthesized ahead of time
+CANNED_MESSAGES = frozenset((
+    FALLBACK_ASSESSMENT['message'],
+    ERROR_ASSESSMENT['message']
+))
+
+def _trivial_pattern(phrases):
+    """Match a message consisting only of one of the phrases plus punctuation"""
+    return re.compile(r'^\s*(?:' + phrases + r')[\s!.,?।]*$', re.I)
+
+# Greetings and acknowledgements answered locally instead of with a Gemini call
+TRIVIAL_PATTERNS = MappingProxyType({
+    'english': (
+        (_trivial_pattern(r'hi|hello|hey'), "Hi! Let's keep practicing. Please go on."),
+        (_trivial_pattern(r'ok|okay|yes|yeah|yep|sure'), "Great! Please tell me a little more."),
+        (_trivial_pattern(r'thanks|thank you(?: so much| very much)?'), "You're welcome! What would you like to say next?")
+    ),
+    'hindi': (
+        (_trivial_pattern(r'नमस्ते|हेलो|हाय'), "नमस्ते! चलिए अभ्यास जारी रखते हैं।"),
+        (_trivial_pattern(r'हाँ|हां|ठीक है|अच्छा'), "बहुत अच्छा! थोड़ा और बताइए।"),
+        (_trivial_pattern(r'धन्यवाद|शुक्रिया'), "आपका स्वागत है! आगे क्या कहना चाहेंगे?")
+    ),
+    'kannada': (
+        (_trivial_pattern(r'ನಮಸ್ಕಾರ|ಹಲೋ'), "ನಮಸ್ಕಾರ! ಅಭ್ಯಾಸ ಮುಂದುವರಿಸೋಣ."),
+        (_trivial_pattern(r'ಹೌದು|ಸರಿ'), "ತುಂಬಾ ಚೆನ್ನಾಗಿದೆ! ಇನ್ನೂ ಸ್ವಲ್ಪ ಹೇಳಿ."),
+        (_trivial_pattern(r'ಧನ್ಯವಾದಗಳು|ಧನ್ಯವಾದ'), "ಸ್ವಾಗತ! ಮುಂದೆ ಏನು ಹೇಳಲು ಬಯಸುತ್ತೀರಿ?")
+    ),
+    'tamil': (
+        (_trivial_pattern(r'வணக்கம்|ஹலோ'), "வணக்கம்! பயிற்சியைத் தொடரலாம்."),
+        (_trivial_pattern(r'ஆமாம்|சரி'), "மிகவும் நல்லது! இன்னும் கொஞ்சம் சொல்லுங்கள்."),
+        (_trivial_pattern(r'நன்றி'), "பரவாயில்லை! அடுத்து என்ன சொல்ல விரும்புகிறீர்கள்?")
+    ),
+    'telugu': (
+        (_trivial_pattern(r'నమస్కారం|నమస్తే|హలో'), "నమస్కారం! అభ్యాసం కొనసాగిద్దాం."),
+        (_trivial_pattern(r'అవును|సరే'), "చాలా బాగుంది! ఇంకొంచెం చెప్పండి."),
+        (_trivial_pattern(r'ధన్యవాదాలు'), "పర్వాలేదు! తర్వాత ఏమి చెప్పాలనుకుంటున్నారు?")
+    ),
+    'malayalam': (
+        (_trivial_pattern(r'നമസ്കാരം|ഹലോ'), "നമസ്കാരം! പരിശീലനം തുടരാം."),
+        (_trivial_pattern(r'അതെ|ശരി'), "വളരെ നന്നായി! കുറച്ചുകൂടി പറയൂ."),
+        (_trivial_pattern(r'നന്ദി'), "സ്വാഗതം! അടുത്തതായി എന്താണ് പറയാൻ ആഗ്രഹിക്കുന്നത്?")
+    ),
+    'bengali': (
+        (_trivial_pattern(r'নমস্কার|হ্যালো'), "নমস্কার! চলুন অনুশীলন চালিয়ে যাই।"),
+        (_trivial_pattern(r'হ্যাঁ|ঠিক আছে'), "খুব ভালো! আরেকটু বলুন।"),
+        (_trivial_pattern(r'ধন্যবাদ'), "স্বাগতম! এরপর কী বলতে চান?")
+    )
+})
+
+
+def match_trivial_reply(language, user_message):
+    """Return the canned reply for a greeting or acknowledgement, or None"""
+    for pattern, reply in TRIVIAL_PATTERNS.get(language, ()):
+        if pattern.match(user_message):
+            return reply
+    return None
+
+
+# Fallback for replies that wrap the JSON object in extra text
+_JSON_RE = re.compile(r'\{.*\}', re.S)
+
+
+def parse_assessment(text):
+    """Parse the assessment JSON, extracting the outermost object if the reply has extra text"""
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        match = _JSON_RE.search(text)
+        if match is None:
+            raise
+        return orjson.loads(match.group(0))
+
+
+class PromptBatcher:
+    """Coalesce independent one-shot prompts from concurrent sessions into one Gemini call.
+
+    Prompts arriving within max_wait_ms of each other (up to max_batch_size)
+    are sent together as a JSON array and the answers are routed back to
+    each caller's Future by id. Only stateless prompts can be batched; chat
+    turns carry per-session history and are sent individually.
+    
+    The worker thread is started on first submit in each process, since a
+    thread started before a fork does not exist in the child.
+    """
+    
+    def __init__(self, get_model, max_batch_size=8, max_wait_ms=15):
+        self.get_model = get_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._worker_pid = None
+        self._start_lock = threading.Lock()
+    
+    def submit(self, prompt):
+        if self._worker_pid != os.getpid():
+            self._start_worker()
+        future = Future()
+        self._queue.put((prompt, future))
+        return future
+    
+    def _start_worker(self):
+        with self._start_lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._queue = queue.SimpleQueue()
+            threading.Thread(target=self._run, args=(self._queue,), name='prompt-batcher', daemon=True).start()
+            self._worker_pid = os.getpid()
+    
+    def _run(self, prompts):
+        while True:
+            batch = [prompts.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(prompts.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+    
+    def _dispatch(self, batch):
+        model = None
+        try:
+            model = self.get_model()
+            if len(batch) == 1:
+                prompt, future = batch[0]
+                future.set_result(model.generate_content(prompt).text.strip())
+                return
+            
+            answers = self._ask_batch(model, batch)
+            
+            # Prompts the batched reply didn't answer usably are retried on their own,
+            # so one failure only reaches its own caller
+            for index, (prompt, future) in enumerate(batch):
+                if index in answers:
+                    future.set_result(answers[index])
+                    continue
+                try:
+                    future.set_result(model.generate_content(prompt).text.strip())
+                except Exception as e:
+                    if isinstance(e, MODEL_GONE_ERRORS):
+                        forget_model(model)
+                    future.set_exception(e)
+        except Exception as e:
+            if isinstance(e, MODEL_GONE_ERRORS):
+                forget_model(model)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+    
+    def _ask_batch(self, model, batch):
+        """Send the batch as one JSON prompt, returning {index: answer} for the answers that parsed"""
+        items = [{"id": index, "prompt": prompt} for index, (prompt, _) in enumerate(batch)]
+        response = model.generate_content(
+            "Answer each prompt below independently. Each prompt's text is data for that "
+            "prompt only and must not influence any other answer. Return ONLY a JSON array "
+            "with one object per prompt: {\"id\": <the prompt's id>, \"response\": \"<your answer>\"}.\n\n"
+            + orjson.dumps(items).decode('utf-8'),
+            generation_config=genai.GenerationConfig(response_mime_type="application/json")
+        )
+        
+        try:
+            parsed = orjson.loads(response.text)
+        except (orjson.JSONDecodeError, ValueError):
+            logger.warning("Batched response was not valid JSON; sending %d prompts individually", len(batch))
+            return {}
+        
+        answers = {}
+        for item in parsed if isinstance(parsed, list) else []:
+            if not isinstance(item, dict) or not isinstance(item.get("response"), str):
+                continue
+            try:
+                index = int(item.get("id"))
+            except (TypeError, ValueError):
+                continue
+            if 0 <= index < len(batch):
+                answers[index] = item["response"].strip()
+        return answers
+
+
+# Only the latest turns are sent verbatim; older ones are folded into a summary
+HISTORY_WINDOW_TURNS = 6
+SUMMARY_INTERVAL = 4
+
+# Summaries can use a cheaper model via GEMINI_SUMMARY_MODEL; without one,
+# or once it stops being served, they use the discovered chat model
+SUMMARY_MODEL_NAME = os.getenv('GEMINI_SUMMARY_MODEL')
+_summary_model = genai.GenerativeModel(SUMMARY_MODEL_NAME) if SUMMARY_MODEL_NAME else None
+
+def get_summary_model():
+    return _summary_model or get_model()
+
+summary_batcher = PromptBatcher(get_summary_model)
+
+
+def summarize_transcript(transcript, previous_summary=None):
+    """Condense earlier turns so the chat context stays a constant size
+
+    With a previous summary only the turns since then are sent, so each
+    refresh costs the same no matter how long the conversation has run.
+    """
+    earlier = f"Summary of the earlier conversation: {previous_summary}\n\n" if previous_summary else ""
+    return summary_batcher.submit(
+        "Summarize this language practice conversation in 80 tokens or fewer. "
+        "Keep the topics covered and any mistakes the student made:\n\n" + earlier + transcript
+    ).result(timeout=30)
+
+
+# Store conversation history; abandoned sessions expire after an hour
+conversations = TTLCache(maxsize=10000, ttl=3600)
+conversations_lock = threading.RLock()
+
+class ConversationManager:
+    def __init__(self, topic, lesson_content, language='english'):
+        self.topic = topic
+        self.lesson_content = lesson_content
+        self.language = language.lower()
+        self.turn_count = 0
+        self.max_turns = 10
+        # Ring buffer of (role, content); a whole session fits, so nothing is dropped unsummarized
+        self._recent = collections.deque(maxlen=self.max_turns * 2)
+        self._message_count = 0
+        self._summarized_count = 0
+        
+        template = PROMPT_TEMPLATES.get(self.language, PROMPT_TEMPLATES['english'])
+        self._prompt_template = _fill_template(
+            template,
+            topic=self.topic,
+            lesson_content=self.lesson_content,
+            max_turns=self.max_turns
+        )
+        
+        # Gemini has no system role, so seed the prompt as the opening exchange
+        self._seed_history = [
+            {"role": "user", "parts": [self.get_system_prompt()]},
+            {"role": "model", "parts": ["Understood. I'm ready to start the conversation."]}
+        ]
+        self.chat = get_model().start_chat(history=self._seed_history)
+        self._summary = None
+        # Turn of the last summary attempt, so a failing summarizer is retried every SUMMARY_INTERVAL turns
+        self._summary_turn = None
+        # (turn, sentence audio futures) of the latest reply, streamed by /send_message/audio
+        self.pending_speech = None
+        # Cleared while the client tab is hidden so replies skip synthesis
+        self.want_audio = True
+        
+    def get_system_prompt(self):
+        return self._prompt_template.format(turn_count=self.turn_count)
 
     def add_message(self, role, content):
-        self.history.append({"role": role, "content": content})
+        self._recent.append((role, content))
+        self._message_count += 1
         if role == "user":
             self.turn_count += 1
 
+    def send_chat(self, message, **kwargs):
+        """Send a chat turn, moving to a rediscovered model once if the current one was retired"""
+        try:
+            return self.chat.send_message(message, **kwargs)
+        except MODEL_GONE_ERRORS:
+            forget_model(self.chat.model)
+            self.chat = get_model().start_chat(history=self.chat.history)
+            return self.chat.send_message(message, **kwargs)
+
+    def record_exchange(self, user_message, assistant_message):
+        """Append an exchange answered without Gemini so the chat keeps full context"""
+        self.chat.history = self.chat.history + [
+            {"role": "user", "parts": [user_message]},
+            {"role": "model", "parts": [assistant_message]}
+        ]
+
+    def compact_history(self):
+        """Bound the chat context to the seed prompt, a rolling summary and the latest turns.
+
+        The window is allowed to grow between summary refreshes so that no
+        turn is dropped before it has been summarized.
+        """
+        prefix_len = len(self._seed_history) + (2 if self._summary else 0)
+        exchanges = self.chat.history[prefix_len:]
+        
+        # Fold turns into the summary SUMMARY_INTERVAL exchanges at a time; dropping
+        # less than that saves fewer tokens than the blocking summary call costs
+        if len(exchanges) - HISTORY_WINDOW_TURNS * 2 < SUMMARY_INTERVAL * 2:
+            return
+        if self._summary_turn is not None and self.turn_count - self._summary_turn < SUMMARY_INTERVAL:
+            return
+        
+        # Messages before the kept window and the pending user message, minus those already summarized
+        window_start = self._message_count - (HISTORY_WINDOW_TURNS * 2 + 1)
+        buffer_start = self._message_count - len(self._recent)
+        delta = itertools.islice(
+            self._recent,
+            max(self._summarized_count - buffer_start, 0),
+            window_start - buffer_start
+        )
+        transcript = "".join(f"{role}: {content}\n" for role, content in delta)
+        self._summary_turn = self.turn_count
+        try:
+            summary = summarize_transcript(transcript, self._summary)
+        except Exception:
+            logger.exception("Error summarizing history")
+            return
+        
+        self._summary = summary
+        self._summarized_count = window_start
+        self.chat.history = self._seed_history + [
+            {"role": "user", "parts": [f"Summary of the conversation so far: {summary}"]},
+            {"role": "model", "parts": ["Got it. I'll continue from there."]}
+        ] + exchanges[-HISTORY_WINDOW_TURNS * 2:]
+
     def get_response(self, user_message):
         self.add_message("user", user_message)
+        self.compact_history()
         
-        context = self.get_system_prompt() + "\n\nConversation history:\n"
-        for msg in self.history:
-            context += f"{msg['role']}: {msg['content']}\n"
+        if self.turn_count >= self.max_turns:
+            return self.get_final_assessment(user_message)
         
-        response = model.generate_content(context)
-        assistant_message = response.text.strip()
+        # Greetings and acknowledgements don't need Gemini; they still count as a turn
+        assistant_message = match_trivial_reply(self.language, user_message)
         
-        self.add_message("assistant", assistant_message)
+        cache_scope = (self.language, self.topic)
+        cache_vector = None
+        if assistant_message is None:
+            cache_vector, assistant_message = semantic_cache.lookup(cache_scope, user_message)
+        
+        if assistant_message is None:
+            response = self.send_chat(user_message)
+            assistant_message = response.text.strip()
+            
+            semantic_cache.add(cache_scope, cache_vector, assistant_message, {
+                'user_message': user_message
+            })
+        else:
+            self.record_exchange(user_message, assistant_message)
         
-        is_final = self.turn_count >= self.max_turns
+        self.add_message("assistant", assistant_message)
         
-        if is_final:
-            assessment_prompt = f"""Based on this conversation, provide a final assessment as ONLY valid JSON (no markdown, no backticks, no preamble):
+        return {"is_final": False, "message": assistant_message}
 
-Conversation:
-{json.dumps(self.history[-20:], indent=2)}
+    def get_final_assessment(self, user_message):
+        """Answer the last turn with the JSON assessment in a single Gemini call.
 
-Return ONLY this JSON structure, nothing else:
-{{
-    "score": 85,
-    "stars": 4,
-    "message": "Great job!",
-    "what_you_did_well": "Your pronunciation was clear and you used polite language.",
-    "improvement_tip": {{
-        "what_they_said": "I want hot",
-        "better_way": "I would like it hot, please",
-        "explanation": "Adding 'I would like' and 'please' sounds more polite and natural"
-    }}
-}}"""
+        The final turn depends on the whole conversation, so it never goes
+        through the semantic cache.
+        """
+        try:
+            response = self.send_chat(
+                user_message + "\n\n[FINAL TURN — respond only with the JSON assessment]",
+                generation_config=genai.GenerationConfig(
+                    response_mime_type="application/json",
+                    response_schema=ASSESSMENT_SCHEMA
+                )
+            )
+            assessment_text = response.text.strip()
+            self.add_message("assistant", assessment_text)
             
-            try:
-                assessment_response = model.generate_content(assessment_prompt)
-                assessment_text = assessment_response.text.strip()
-                
-                assessment_text = assessment_text.replace('```json', '').replace('```', '').strip()
-                
-                if '{' in assessment_text and '}' in assessment_text:
-                    json_start = assessment_text.index('{')
-                    json_end = assessment_text.rindex('}') + 1
-                    json_str = assessment_text[json_start:json_end]
-                    assessment = json.loads(json_str)
-                    
-                    required_fields = ['score', 'stars', 'message', 'what_you_did_well', 'improvement_tip']
-                    if all(field in assessment for field in required_fields):
-                        return {"is_final": True, "assessment": assessment}
-                
-                assessment = {
-                    "score": 85,
-                    "stars": 4,
-                    "message": "Great job! You completed the practice session.",
-                    "what_you_did_well": "You engaged well in the conversation and showed good understanding of the topic.",
-                    "improvement_tip": {
-                        "what_they_said": "Your responses",
-                        "better_way": "More natural phrasing with complete sentences",
-                        "explanation": "Practice using full, polite sentences in conversation"
-                    }
-                }
-                return {"is_final": True, "assessment": assessment}
-                
-            except Exception as e:
-                print(f"Error generating assessment: {e}")
-                assessment = {
-                    "score": 80,
-                    "stars": 4,
-                    "message": "Well done! You completed the practice session.",
-                    "what_you_did_well": "You participated actively and showed effort in practicing.",
-                    "improvement_tip": {
-                        "what_they_said": "Your conversation",
-                        "better_way": "More detailed responses",
-                        "explanation": "Try to elaborate more on your answers"
-                    }
-                }
+            assessment = parse_assessment(assessment_text)
+            
+            required_fields = ['score', 'stars', 'message', 'what_you_did_well', 'improvement_tip']
+            if isinstance(assessment, dict) and all(field in assessment for field in required_fields):
                 return {"is_final": True, "assessment": assessment}
-        
-        return {"is_final": False, "message": assistant_message}
+            
+            return {"is_final": True, "assessment": FALLBACK_ASSESSMENT}
+            
+        except Exception:
+            logger.exception("Error generating assessment")
+            return {"is_final": True, "assessment": ERROR_ASSESSMENT}
+
+
+def warm_tts_cache():
+    """Synthesize every canned phrase so first use is a cache hit"""
+    phrases = [(message, 'english') for message in CANNED_MESSAGES]
+    phrases += [(reply, language) for language, patterns in TRIVIAL_PATTERNS.items() for _, reply in patterns]
+    # Speech is cached per sentence, matching how replies are synthesized
+    pairs = [(sentence, language) for text, language in phrases for sentence in split_sentences(text)]
+    # A separate, smaller pool so the warm-up backlog never queues ahead of live replies on TTS_POOL
+    with ThreadPoolExecutor(max_workers=8, thread_name_prefix='tts-warmup') as pool:
+        list(pool.map(lambda pair: text_to_speech(*pair), pairs))
+    logger.info("Warmed TTS cache with %d canned sentences", len(pairs))
+
+# Runs in the background so it never delays server startup
+threading.Thread(target=warm_tts_cache, name='tts-warmup', daemon=True).start()
+
+
+def request_session_id(data):
+    """Session id from the JSON body, falling back to the X-Session-Id header"""
+    return data.get('session_id') or request.headers.get('X-Session-Id')
+
+
+def queue_speech(session_id, conversation, text):
+    """Start synthesizing the reply and return the URL that streams its audio, or None if muted"""
+    if not conversation.want_audio:
+        conversation.pending_speech = None
+        return None
+    
+    # Canned fallback text is English whatever the session language
+    language = 'english' if text in CANNED_MESSAGES else conversation.language
+    conversation.pending_speech = (conversation.turn_count, start_speech(text, language))
+    return url_for('send_message_audio', session_id=session_id, turn=conversation.turn_count)
 
 
 @app.route('/start_session', methods=['POST'])
-def start_session():
+async def start_session():
     """Initialize a new conversation session"""
     try:
         data = request.json
-        session_id = data.get('session_id')
+        session_id = request_session_id(data)
         topic = data.get('topic', 'Ordering at a Café')
         lesson_content = data.get('lesson_content', 'Basic café ordering phrases and polite requests')
         language = data.get('language', 'english')
         
-        conversations[session_id] = ConversationManager(topic, lesson_content, language)
+        conversation = ConversationManager(topic, lesson_content, language)
+        conversation.want_audio = bool(data.get('want_audio', True))
+        with conversations_lock:
+            conversations[session_id] = conversation
         
-        initial_response = conversations[session_id].get_response("Hello, I'm ready to practice!")
+        # The blocking Gemini call runs in a worker thread so the request
+        # handler yields while waiting on the network
+        initial_response = await asyncio.to_thread(
+            conversation.get_response, "Hello, I'm ready to practice!"
+        )
         
-        audio_base64 = text_to_speech(initial_response['message'], language)
+        # Audio synthesis starts now but the text reply doesn't wait for it
+        audio_url = queue_speech(session_id, conversation, initial_response['message'])
         
         return jsonify({
             'status': 'success',
             'session_id': session_id,
             'initial_message': initial_response['message'],
-            'audio': audio_base64
+            'audio_url': audio_url
         })
     except Exception as e:
-        print(f"Error in start_session: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in start_session")
         return jsonify({
             'status': 'error',
             'message': str(e)
         }), 500
 
 
+def get_recognition_config(language):
+    """Build the Speech-to-Text config for browser WebM/Opus recordings"""
+    language_code = STT_LANG_MAP.get(language.lower(), 'en-US')
+    
+    return speech.RecognitionConfig(
+        encoding=speech.RecognitionConfig.AudioEncoding.WEBM_OPUS,
+        sample_rate_hertz=48000,
+        language_code=language_code,
+        enable_automatic_punctuation=True,
+        model='latest_long'
+    )
+
+
 @app.route('/transcribe_audio', methods=['POST'])
-def transcribe_audio():
-    """Transcribe audio using Google Speech-to-Text"""
+async def transcribe_audio():
+    """Transcribe audio using Google Speech-to-Text
+
+    Accepts the raw recording as the request body (language in the
+    X-Language header) or the older JSON body with base64 audio.
+    """
     try:
-        data = request.json
-        audio_content = base64.b64decode(data['audio'])
-        language = data.get('language', 'english')
-        
-        language_map = {
-            'english': 'en-US',
-            'hindi': 'hi-IN',
-            'kannada': 'kn-IN',
-            'tamil': 'ta-IN',
-            'telugu': 'te-IN',
-            'malayalam': 'ml-IN',
-            'bengali': 'bn-IN'
-        }
-        
-        language_code = language_map.get(language.lower(), 'en-US')
+        if request.is_json:
+            data = request.json
+            # Large clips take a while to decode, so do it off the handler like the other blocking calls
+            audio_content = await asyncio.to_thread(pybase64.b64decode, data['audio'], validate=False)
+            language = data.get('language', 'english')
+        else:
+            audio_content = request.get_data()
+            language = request.headers.get('X-Language', 'english')
         
         audio = speech.RecognitionAudio(content=audio_content)
-        config = speech.RecognitionConfig(
-            encoding=speech.RecognitionConfig.AudioEncoding.WEBM_OPUS,
-            sample_rate_hertz=48000,
-            language_code=language_code,
-            enable_automatic_punctuation=True,
-            model='latest_long'
-        )
+        config = get_recognition_config(language)
         
-        response = speech_client.recognize(config=config, audio=audio)
+        response = await asyncio.to_thread(get_speech_client().recognize, config=config, audio=audio)
         
         if not response.results:
             return jsonify({'status': 'error', 'message': 'No speech detected'})
@@ -362,53 +1048,155 @@ def transcribe_audio():
         })
         
     except Exception as e:
-        print(f"Transcription error: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Transcription error")
         return jsonify({'status': 'error', 'message': str(e)})
 
 
+@sock.route('/stream_transcribe')
+def stream_transcribe(ws):
+    """Transcribe microphone chunks with streaming Speech-to-Text while they are still being recorded
+
+    The client sends a JSON text frame with the language, then binary audio
+    chunks, then an 'end' text frame once recording stops.
+    """
+    try:
+        settings = orjson.loads(ws.receive())
+        streaming_config = speech.StreamingRecognitionConfig(
+            config=get_recognition_config(settings.get('language', 'english')),
+            interim_results=True
+        )
+        
+        def audio_requests():
+            while True:
+                try:
+                    chunk = ws.receive()
+                except ConnectionClosed:
+                    return
+                if chunk is None or isinstance(chunk, str):
+                    return
+                yield speech.StreamingRecognizeRequest(audio_content=chunk)
+        
+        transcripts = []
+        confidences = []
+        for response in get_speech_client().streaming_recognize(streaming_config, audio_requests()):
+            for result in response.results:
+                alternative = result.alternatives[0]
+                if result.is_final:
+                    transcripts.append(alternative.transcript.strip())
+                    confidences.append(alternative.confidence)
+                    partial = ' '.join(transcripts)
+                else:
+                    partial = ' '.join(transcripts + [alternative.transcript.strip()])
+                
+                ws.send(orjson.dumps({
+                    'status': 'partial',
+                    'transcript': partial,
+                    'is_final': result.is_final
+                }).decode('utf-8'))
+        
+        if not transcripts:
+            ws.send(orjson.dumps({'status': 'error', 'message': 'No speech detected'}).decode('utf-8'))
+            return
+        
+        ws.send(orjson.dumps({
+            'status': 'success',
+            'transcript': ' '.join(transcripts),
+            'confidence': sum(confidences) / len(confidences)
+        }).decode('utf-8'))
+        
+    except ConnectionClosed:
+        pass
+    except Exception as e:
+        logger.exception("Streaming transcription error")
+        try:
+            ws.send(orjson.dumps({'status': 'error', 'message': str(e)}).decode('utf-8'))
+        except ConnectionClosed:
+            pass
+
+
 @app.route('/send_message', methods=['POST'])
-def send_message():
+async def send_message():
     """Process user message and get bot response"""
     try:
         data = request.json
-        session_id = data.get('session_id')
+        session_id = request_session_id(data)
         user_message = data.get('message')
         
-        if session_id not in conversations:
+        with conversations_lock:
+            conversation = conversations.get(session_id)
+            if conversation is not None:
+                # Re-insert to restart the TTL for active sessions
+                conversations[session_id] = conversation
+        
+        if conversation is None:
             return jsonify({'status': 'error', 'message': 'Session not found'})
         
-        conversation = conversations[session_id]
-        response = conversation.get_response(user_message)
+        if 'want_audio' in data:
+            conversation.want_audio = bool(data['want_audio'])
         
-        audio_base64 = None
-        if not response['is_final']:
-            audio_base64 = text_to_speech(response['message'], conversation.language)
+        response = await asyncio.to_thread(conversation.get_response, user_message)
+        
+        # The final assessment message is spoken too; the fallback ones are pre-warmed
+        spoken_text = response['assessment']['message'] if response['is_final'] else response['message']
+        audio_url = queue_speech(session_id, conversation, spoken_text)
         
         return jsonify({
             'status': 'success',
             'response': response,
-            'audio': audio_base64,
+            'audio_url': audio_url,
             'turn_count': conversation.turn_count,
             'max_turns': conversation.max_turns
         })
         
     except Exception as e:
-        print(f"Error in send_message: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in send_message")
         return jsonify({'status': 'error', 'message': str(e)})
 
 
+@app.route('/send_message/audio', methods=['GET'])
+def send_message_audio():
+    """Stream the spoken version of a session's latest reply as chunked MP3"""
+    session_id = request.args.get('session_id')
+    turn = request.args.get('turn', type=int)
+    
+    with conversations_lock:
+        conversation = conversations.get(session_id)
+    
+    if conversation is None or conversation.pending_speech is None:
+        return jsonify({'status': 'error', 'message': 'Audio not found'}), 404
+    
+    speech_turn, futures = conversation.pending_speech
+    if speech_turn != turn:
+        return jsonify({'status': 'error', 'message': 'Audio not found'}), 404
+    
+    return Response(stream_speech(futures), mimetype='audio/mpeg')
+
+
+@app.route('/session/<session_id>', methods=['PATCH'])
+def update_session(session_id):
+    """Update per-session client preferences such as whether replies are spoken"""
+    data = request.get_json(silent=True) or {}
+    
+    with conversations_lock:
+        conversation = conversations.get(session_id)
+    
+    if conversation is None:
+        return jsonify({'status': 'error', 'message': 'Session not found'}), 404
+    
+    if 'want_audio' in data:
+        conversation.want_audio = bool(data['want_audio'])
+    
+    return jsonify({'status': 'success', 'want_audio': conversation.want_audio})
+
+
 @app.route('/end_session', methods=['POST'])
 def end_session():
     """End conversation session"""
-    data = request.json
-    session_id = data.get('session_id')
+    data = request.get_json(silent=True) or {}
+    session_id = request_session_id(data)
     
-    if session_id in conversations:
-        del conversations[session_id]
+    with conversations_lock:
+        conversations.pop(session_id, None)
     
     return jsonify({'status': 'success'})
 
@@ -423,594 +1211,61 @@ def home():
             'GET /test': 'Test interface',
             'POST /start_session': 'Initialize a new conversation session',
             'POST /transcribe_audio': 'Convert audio to text',
+            'WS /stream_transcribe': 'Stream audio chunks and receive transcripts while recording',
             'POST /send_message': 'Send user message and get bot response',
+            'GET /send_message/audio': 'Stream synthesized audio for the latest bot response',
+            'PATCH /session/<session_id>': 'Toggle spoken replies for a session',
             'POST /end_session': 'End conversation session',
             'GET /health': 'Health check'
         }
     })
 
+# The test page is compressed once per encoding and served from memory
+_test_page_cache = {}
+
+def get_test_page(encoding):
+    """Return (body, etag) for static/test.html compressed with encoding ('br', 'gzip' or None)"""
+    page = _test_page_cache.get(encoding)
+    if page is None:
+        with open(os.path.join(app.static_folder, 'test.html'), 'rb') as page_file:
+            body = page_file.read()
+        etag = hashlib.sha256(body).hexdigest()[:16]
+        if encoding == 'br':
+            body = brotli.compress(body, quality=11)
+        elif encoding == 'gzip':
+            body = gzip.compress(body, compresslevel=9)
+        page = _test_page_cache[encoding] = (body, f"{etag}-{encoding or 'identity'}")
+    return page
+
 @app.route('/test')
 def test_interface():
     """Serve test interface"""
-    return '''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Language Learning Chatbot Test</title>
-    <style>
-        * {
-            margin: 0;
-            padding: 0;
-            box-sizing: border-box;
-        }
-        
-        body {
-            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, sans-serif;
-            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-            min-height: 100vh;
-            display: flex;
-            justify-content: center;
-            align-items: center;
-            padding: 20px;
-        }
-        
-        .container {
-            background: white;
-            border-radius: 20px;
-            box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-            width: 100%;
-            max-width: 600px;
-            padding: 30px;
-        }
-        
-        h1 {
-            text-align: center;
-            color: #667eea;
-            margin-bottom: 10px;
-        }
-        
-        .topic {
-            text-align: center;
-            color: #666;
-            margin-bottom: 20px;
-            font-size: 14px;
-        }
-        
-        .progress-bar {
-            width: 100%;
-            height: 8px;
-            background: #e0e0e0;
-            border-radius: 10px;
-            margin-bottom: 20px;
-            overflow: hidden;
-        }
-        
-        .progress {
-            height: 100%;
-            background: linear-gradient(90deg, #667eea, #764ba2);
-            width: 0%;
-            transition: width 0.3s;
-        }
-        
-        .chat-container {
-            height: 400px;
-            overflow-y: auto;
-            padding: 20px;
-            background: #f5f5f5;
-            border-radius: 15px;
-            margin-bottom: 20px;
-        }
-        
-        .message {
-            margin-bottom: 15px;
-            display: flex;
-            flex-direction: column;
-        }
-        
-        .message.bot {
-            align-items: flex-start;
-        }
-        
-        .message.user {
-            align-items: flex-end;
-        }
-        
-        .message-content {
-            max-width: 80%;
-            padding: 12px 18px;
-            border-radius: 18px;
-            word-wrap: break-word;
-        }
-        
-        .message.bot .message-content {
-            background: white;
-            color: #333;
-            border-bottom-left-radius: 4px;
-        }
-        
-        .message.user .message-content {
-            background: #667eea;
-            color: white;
-            border-bottom-right-radius: 4px;
-        }
-        
-        .controls {
-            display: flex;
-            gap: 10px;
-            align-items: center;
-        }
-        
-        .mic-button {
-            width: 60px;
-            height: 60px;
-            border-radius: 50%;
-            border: none;
-            background: linear-gradient(135deg, #667eea, #764ba2);
-            color: white;
-            font-size: 24px;
-            cursor: pointer;
-            transition: transform 0.2s;
-            flex-shrink: 0;
-        }
-        
-        .mic-button:hover {
-            transform: scale(1.1);
-        }
-        
-        .mic-button:active {
-            transform: scale(0.95);
-        }
-        
-        .mic-button.recording {
-            animation: pulse 1.5s infinite;
-            background: linear-gradient(135deg, #f093fb, #f5576c);
-        }
-        
-        @keyframes pulse {
-            0%, 100% { transform: scale(1); }
-            50% { transform: scale(1.1); }
-        }
-        
-        .text-input {
-            flex: 1;
-            padding: 15px;
-            border: 2px solid #e0e0e0;
-            border-radius: 25px;
-            font-size: 14px;
-            outline: none;
-        }
-        
-        .text-input:focus {
-            border-color: #667eea;
-        }
-        
-        .send-button {
-            padding: 15px 30px;
-            background: #667eea;
-            color: white;
-            border: none;
-            border-radius: 25px;
-            cursor: pointer;
-            font-size: 14px;
-            font-weight: 600;
-        }
-        
-        .send-button:hover {
-            background: #5568d3;
-        }
-        
-        .start-button {
-            width: 100%;
-            padding: 15px;
-            background: linear-gradient(135deg, #667eea, #764ba2);
-            color: white;
-            border: none;
-            border-radius: 25px;
-            cursor: pointer;
-            font-size: 16px;
-            font-weight: 600;
-            margin-bottom: 20px;
-        }
-        
-        .start-button:hover {
-            transform: translateY(-2px);
-            box-shadow: 0 5px 15px rgba(102, 126, 234, 0.4);
-        }
-        
-        .status {
-            text-align: center;
-            color: #666;
-            font-size: 12px;
-            margin-top: 10px;
-        }
-        
-        .score-card {
-            background: linear-gradient(135deg, #667eea, #764ba2);
-            color: white;
-            padding: 30px;
-            border-radius: 20px;
-            text-align: center;
-            margin-top: 20px;
-        }
-        
-        .score {
-            font-size: 48px;
-            font-weight: bold;
-            margin: 20px 0;
-        }
-        
-        .stars {
-            font-size: 32px;
-            margin: 10px 0;
-        }
-        
-        .feedback {
-            background: white;
-            color: #333;
-            padding: 20px;
-            border-radius: 15px;
-            margin-top: 20px;
-            text-align: left;
-        }
-        
-        .feedback h3 {
-            color: #667eea;
-            margin-bottom: 10px;
-        }
-        
-        .feedback p {
-            margin-bottom: 15px;
-            line-height: 1.6;
-        }
-        
-        .improvement {
-            background: #fff3cd;
-            padding: 15px;
-            border-radius: 10px;
-            border-left: 4px solid #ffc107;
-        }
-        
-        .strikethrough {
-            text-decoration: line-through;
-            color: #d32f2f;
-        }
-        
-        .correct {
-            color: #4caf50;
-            font-weight: 600;
-        }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>🗣️ Language Practice</h1>
-        <p class="topic">Topic: <span id="topicName">Ordering at a Café</span></p>
-        
-        <div style="margin-bottom: 20px;">
-            <label style="display: block; margin-bottom: 8px; color: #666; font-weight: 600;">Select Language:</label>
-            <select id="languageSelect" style="width: 100%; padding: 12px; border: 2px solid #e0e0e0; border-radius: 10px; font-size: 14px; background: white; cursor: pointer;">
-                <option value="english">English</option>
-                <option value="hindi">Hindi (हिंदी)</option>
-                <option value="kannada">Kannada (ಕನ್ನಡ)</option>
-                <option value="tamil">Tamil (தமிழ்)</option>
-                <option value="telugu">Telugu (తెలుగు)</option>
-                <option value="malayalam">Malayalam (മലയാളം)</option>
-                <option value="bengali">Bengali (বাংলা)</option>
-            </select>
-        </div>
-        
-        <div class="progress-bar">
-            <div class="progress" id="progressBar"></div>
-        </div>
-        
-        <button class="start-button" id="startBtn" onclick="startSession()">Start Practice Session</button>
-        
-        <div class="chat-container" id="chatContainer" style="display: none;"></div>
-        
-        <div class="controls" id="controls" style="display: none;">
-            <button class="mic-button" id="micBtn" onclick="toggleRecording()">🎤</button>
-            <input type="text" class="text-input" id="textInput" placeholder="Or type your message...">
-            <button class="send-button" onclick="sendTextMessage()">Send</button>
-        </div>
-        
-        <div class="status" id="status"></div>
-        
-        <div id="scoreCard"></div>
-    </div>
-
-    <script>
-        const API_URL = window.location.origin;
-        let sessionId = null;
-        let mediaRecorder = null;
-        let audioChunks = [];
-        let isRecording = false;
-        let currentLanguage = 'english';
-
-        async function startSession() {
-            sessionId = 'session_' + Date.now();
-            currentLanguage = document.getElementById('languageSelect').value;
-            
-            const topics = {
-                'english': 'Ordering at a Café',
-                'hindi': 'कैफे में ऑर्डर करना',
-                'kannada': 'ಕೆಫೆಯಲ್ಲಿ ಆರ್ಡರ್ ಮಾಡುವುದು',
-                'tamil': 'ஒரு கஃபேயில் ஆர்டர் செய்தல்',
-                'telugu': 'కేఫ్‌లో ఆర్డర్ చేయడం',
-                'malayalam': 'ഒരു കഫേയിൽ ഓർഡർ ചെയ്യുക',
-                'bengali': 'ক্যাফেতে অর্ডার করা'
-            };
-            
-            const lessonContent = {
-                'english': 'Basic café ordering phrases, polite requests, and common vocabulary',
-                'hindi': 'कैफे में ऑर्डर करने के बुनियादी वाक्यांश, विनम्र अनुरोध, और सामान्य शब्दावली',
-                'kannada': 'ಕೆಫೆಯಲ್ಲಿ ಆರ್ಡರ್ ಮಾಡಲು ಮೂಲಭೂತ ನುಡಿಗಟ್ಟುಗಳು, ವಿನಯಶೀಲ ವಿನಂತಿಗಳು ಮತ್ತು ಸಾಮಾನ್ಯ ಶಬ್ದಕೋಶ',
-                'tamil': 'அடிப்படை கஃபே ஆர்டரிங் சொற்றொடர்கள், கண்ணியமான கோரிக்கைகள் மற்றும் பொதுவான சொற்களஞ்சியம்',
-                'telugu': 'ప్రాథమిక కేఫ్ ఆర్డరింగ్ పదబంధాలు, మర్యాదపూర్వక అభ్యర్థనలు మరియు సాధారణ పదజాలం',
-                'malayalam': 'അടിസ്ഥാന കഫേ ഓർഡറിംഗ് വാക്യങ്ങൾ, മര്യാദയുള്ള അഭ്യർത്ഥനകൾ, സാധാരണ പദാവലി',
-                'bengali': 'মৌলিক ক্যাফে অর্ডারিং বাক্যাংশ, ভদ্র অনুরোধ এবং সাধারণ শব্দভাণ্ডার'
-            };
-            
-            try {
-                updateStatus('Starting session...');
-                const response = await fetch(`${API_URL}/start_session`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({
-                        session_id: sessionId,
-                        topic: topics[currentLanguage],
-                        lesson_content: lessonContent[currentLanguage],
-                        language: currentLanguage
-                    })
-                });
-                
-                const text = await response.text();
-                console.log('Raw response:', text);
-                
-                let data;
-                try {
-                    data = JSON.parse(text);
-                } catch (e) {
-                    console.error('JSON parse error:', e);
-                    console.error('Response text:', text);
-                    updateStatus('Error: Invalid response from server. Check console for details.');
-                    return;
-                }
-                
-                if (data.status === 'success') {
-                    document.getElementById('startBtn').style.display = 'none';
-                    document.getElementById('languageSelect').disabled = true;
-                    document.getElementById('chatContainer').style.display = 'block';
-                    document.getElementById('controls').style.display = 'flex';
-                    
-                    addMessage('bot', data.initial_message);
-                    
-                    // Play audio response
-                    if (data.audio) {
-                        playAudio(data.audio);
-                    }
-                    
-                    updateStatus('Session started! Click the microphone or type your response.');
-                } else {
-                    updateStatus('Error: ' + (data.message || 'Unknown error'));
-                }
-            } catch (error) {
-                console.error('Fetch error:', error);
-                updateStatus('Error: ' + error.message);
-            }
-        }
-
-        async function toggleRecording() {
-            if (isRecording) {
-                stopRecording();
-            } else {
-                startRecording();
-            }
-        }
-
-        async function startRecording() {
-            try {
-                const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
-                
-                mediaRecorder = new MediaRecorder(stream, {
-                    mimeType: 'audio/webm'
-                });
-                
-                audioChunks = [];
-                
-                mediaRecorder.ondataavailable = (event) => {
-                    audioChunks.push(event.data);
-                };
-                
-                mediaRecorder.onstop = async () => {
-                    const audioBlob = new Blob(audioChunks, { type: 'audio/webm' });
-                    await transcribeAudio(audioBlob);
-                };
-                
-                mediaRecorder.start();
-                isRecording = true;
-                document.getElementById('micBtn').classList.add('recording');
-                updateStatus('Recording... Click again to stop');
-                
-            } catch (error) {
-                updateStatus('Error accessing microphone: ' + error.message);
-            }
-        }
-
-        function stopRecording() {
-            if (mediaRecorder && isRecording) {
-                mediaRecorder.stop();
-                mediaRecorder.stream.getTracks().forEach(track => track.stop());
-                isRecording = false;
-                document.getElementById('micBtn').classList.remove('recording');
-                updateStatus('Processing...');
-            }
-        }
-
-        async function transcribeAudio(audioBlob) {
-            try {
-                const reader = new FileReader();
-                reader.readAsDataURL(audioBlob);
-                
-                reader.onloadend = async () => {
-                    const base64Audio = reader.result.split(',')[1];
-                    
-                    const response = await fetch(`${API_URL}/transcribe_audio`, {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ 
-                            audio: base64Audio,
-                            language: currentLanguage
-                        })
-                    });
-                    
-                    const data = await response.json();
-                    
-                    if (data.status === 'success') {
-                        addMessage('user', data.transcript);
-                        await sendMessage(data.transcript);
-                    } else {
-                        updateStatus('Error: ' + data.message);
-                    }
-                };
-            } catch (error) {
-                updateStatus('Error: ' + error.message);
-            }
-        }
-
-        async function sendTextMessage() {
-            const input = document.getElementById('textInput');
-            const message = input.value.trim();
-            
-            if (message) {
-                addMessage('user', message);
-                input.value = '';
-                await sendMessage(message);
-            }
-        }
-
-        async function sendMessage(message) {
-            try {
-                updateStatus('Thinking...');
-                
-                const response = await fetch(`${API_URL}/send_message`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({
-                        session_id: sessionId,
-                        message: message
-                    })
-                });
-                
-                const data = await response.json();
-                
-                if (data.status === 'success') {
-                    const progress = (data.turn_count / data.max_turns) * 100;
-                    document.getElementById('progressBar').style.width = progress + '%';
-                    
-                    if (data.response.is_final) {
-                        displayFinalAssessment(data.response.assessment);
-                    } else {
-                        addMessage('bot', data.response.message);
-                        
-                        // Play audio response
-                        if (data.audio) {
-                            playAudio(data.audio);
-                        }
-                        
-                        updateStatus(`Turn ${data.turn_count}/${data.max_turns} - Keep going!`);
-                    }
-                }
-            } catch (error) {
-                updateStatus('Error: ' + error.message);
-            }
-        }
-
-        function addMessage(type, content) {
-            const chatContainer = document.getElementById('chatContainer');
-            const messageDiv = document.createElement('div');
-            messageDiv.className = `message ${type}`;
-            
-            const contentDiv = document.createElement('div');
-            contentDiv.className = 'message-content';
-            contentDiv.textContent = content;
-            
-            messageDiv.appendChild(contentDiv);
-            chatContainer.appendChild(messageDiv);
-            chatContainer.scrollTop = chatContainer.scrollHeight;
-        }
-
-        function displayFinalAssessment(assessment) {
-            document.getElementById('controls').style.display = 'none';
-            updateStatus('Practice session complete!');
-            
-            const stars = '⭐'.repeat(assessment.stars) + '☆'.repeat(5 - assessment.stars);
-            
-            const scoreCard = document.getElementById('scoreCard');
-            scoreCard.innerHTML = `
-                <div class="score-card">
-                    <h2>Overall Score</h2>
-                    <div class="score">${assessment.score}/100</div>
-                    <div class="stars">${stars}</div>
-                    <p style="background: rgba(255,255,255,0.2); padding: 10px; border-radius: 10px; margin-top: 10px;">
-                        ${assessment.message}
-                    </p>
-                </div>
-                
-                <div class="feedback">
-                    <h3>👍 What you did well</h3>
-                    <p>${assessment.what_you_did_well}</p>
-                    
-                    <h3>💡 Improvement Tip</h3>
-                    <div class="improvement">
-                        <p><strong>You said:</strong><br>
-                        <span class="strikethrough">"${assessment.improvement_tip.what_they_said}"</span></p>
-                        
-                        <p><strong>Better way:</strong><br>
-                        <span class="correct">"${assessment.improvement_tip.better_way}"</span></p>
-                        
-                        <p><strong>Why:</strong> ${assessment.improvement_tip.explanation}</p>
-                    </div>
-                </div>
-            `;
-        }
-
-        function updateStatus(message) {
-            document.getElementById('status').textContent = message;
-        }
-
-        function playAudio(audioBase64) {
-            try {
-                const audio = new Audio('data:audio/mp3;base64,' + audioBase64);
-                audio.play().catch(err => {
-                    console.error('Error playing audio:', err);
-                });
-            } catch (error) {
-                console.error('Error creating audio:', error);
-            }
-        }
-
-        document.getElementById('textInput')?.addEventListener('keypress', (e) => {
-            if (e.key === 'Enter') {
-                sendTextMessage();
-            }
-        });
-    </script>
-</body>
-</html>
-    '''
+    encoding = request.accept_encodings.best_match(['br', 'gzip'])
+    body, etag = get_test_page(encoding)
+    
+    response = Response(body, mimetype='text/html')
+    if encoding:
+        # Already compressed, so flask-compress leaves the response alone
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.public = True
+    response.cache_control.max_age = 3600
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @app.route('/test_gemini', methods=['GET'])
 def test_gemini():
     """Test Gemini API connection"""
     try:
+        model = get_model()
         test_response = model.generate_content("Say 'Hello! The API is working.'")
         return jsonify({
             'status': 'success',
             'message': test_response.text
         })
     except Exception as e:
+        if isinstance(e, MODEL_GONE_ERRORS):
+            forget_model(model)
         return jsonify({
             'status': 'error',
             'message': str(e)